@@ -5,7 +5,7 @@ def gen_data(name, coord_offset, num, noise=False):
     os.system('python3 mask.py')
     if noise:
         os.system('python3 process_sim.py')
-        os.system('mv images/knots_info.json ./images_noisy/')
+        os.system('mv images/knots_info.jsonl ./images_noisy/')
         os.system('rm -rf images')
         os.system('mv images_noisy ./images')
     os.system('mkdir {}'.format(name))
@@ -1,19 +1,17 @@
-import bpy, bpy_extras
+import bpy
 import sys
-import copy
 from math import *
 import pprint
 from mathutils import *
-import random
 import json
 import numpy as np
 import os
 import time
-from sklearn.neighbors import NearestNeighbors
+from scipy.spatial import cKDTree
 import argparse
 
 class RopeRenderer:
-    def __init__(self, rope_radius=None, sphere_radius=None, rope_iterations=None, rope_screw_offset=None, bezier_scale=3.7, bezier_knots=12, save_depth=True, save_rgb=False, coord_offset=20, num_images=10, nonplanar=True):
+    def __init__(self, rope_radius=None, sphere_radius=None, rope_iterations=None, rope_screw_offset=None, bezier_scale=3.7, bezier_knots=12, save_depth=True, save_rgb=False, coord_offset=20, num_images=10, nonplanar=True, seed=None):
         """
         Initializes the Blender rope renderer
         :param rope_radius: thickness of rope
@@ -26,6 +24,8 @@ class RopeRenderer:
         :type bezier_subdivisions: int
         :param save_rgb: if True, save_rgbs images, else just renders
         :type save_rgb: bool
+        :param seed: seed for the random generator used for all scene randomization (None for a fresh seed)
+        :type seed: int
         :return:
         :rtype:
         """
@@ -38,6 +38,7 @@ class RopeRenderer:
         self.sphere_radius = sphere_radius
         self.rope_iterations = rope_iterations
         self.nonplanar = nonplanar
+        self.rng = np.random.default_rng(seed)
         self.bezier_scale = None
         self.bezier_subdivisions = bezier_knots - 2 # the number of splits in the bezier curve (ctrl points - 2)
         self.origin = (0, 0, 0)
@@ -46,51 +47,47 @@ class RopeRenderer:
         self.rope_asymm = None
         self.bezier = None
         self.bezier_points = None # list of vertices in bezier curve
+        self.num_bezier_points = None # number of vertices in bezier curve, fixed once the curve is made
         self.camera = None
         # Name objects
         self.rope_name = "Rope"
         self.rope_asymm_name = "Rope-Asymmetric"
         self.bezier_name = "Bezier"
         self.camera_name = "Camera"
-        # Dictionary to store pixel vals of knots (vertices)
-        self.knots_info = {}
+        # File that pixel vals of knots (vertices) are streamed to, one JSON line per image
+        self.knots_info = None
         self.i = 0
 
     def clear(self):
         """
         Deletes any objects or meshes in the scene
         """
-        for block in bpy.data.meshes:
-            if block.users == 0:
-                bpy.data.meshes.remove(block)
-        for block in bpy.data.materials:
-            if block.users == 0:
-                bpy.data.materials.remove(block)
-        for block in bpy.data.textures:
-            if block.users == 0:
-                bpy.data.textures.remove(block)
-        for block in bpy.data.images:
-            if block.users == 0:
-                bpy.data.images.remove(block)
-        bpy.ops.object.mode_set(mode='OBJECT')
-        bpy.ops.object.select_all(action='SELECT')
-        bpy.ops.object.delete()
+        # Remove objects at the data level (no operator poll/undo overhead), then any data blocks they leave unused
+        for obj in list(bpy.data.objects):
+            bpy.data.objects.remove(obj, do_unlink=True)
+        for blocks in (bpy.data.meshes, bpy.data.curves, bpy.data.cameras, bpy.data.lights, bpy.data.materials, bpy.data.textures, bpy.data.images):
+            for block in list(blocks):
+                if block.users == 0:
+                    blocks.remove(block)
 
     def add_camera(self, fixed=True):
         '''
         Place a camera randomly, fixed means no rotations about z axis (planar camera changes only)
         '''
+        bpy.ops.object.camera_add(location=[0, 0, 10])
+        self.camera = bpy.context.active_object
+        self.camera.name = self.camera_name
+        self.randomize_camera(fixed=fixed)
+        bpy.ops.object.light_add(type='SUN', radius=1, location=(0, 0, 0))
+
+    def randomize_camera(self, fixed=True):
+        # Re-place the existing camera randomly (see add_camera for what fixed means)
         if fixed:
-            bpy.ops.object.camera_add(location=[0, 0, 10])
-            self.camera = bpy.context.active_object
-            self.camera.rotation_euler = (0, 0, random.uniform(-pi/8, pi/8)) # fixed z, rotate only about x/y axis slightly
-            self.camera.name = self.camera_name
+            self.camera.location = (0, 0, 10)
+            self.camera.rotation_euler = (0, 0, self.rng.uniform(-pi/8, pi/8)) # fixed z, rotate only about x/y axis slightly
         else:
-            bpy.ops.object.camera_add(location=[random.uniform(-1, 1), random.uniform(-1, 1), random.uniform(-1, 1)])
-            self.camera = bpy.context.active_object
-            self.camera.name = self.camera_name
-            self.camera.rotation_euler = (random.uniform(-pi/4, pi/4), random.uniform(-pi/4, pi/4), random.uniform(-pi, pi))
-        bpy.ops.object.light_add(type='SUN', radius=1, location=(0, 0, 0))
+            self.camera.location = (self.rng.uniform(-1, 1), self.rng.uniform(-1, 1), self.rng.uniform(-1, 1))
+            self.camera.rotation_euler = (self.rng.uniform(-pi/4, pi/4), self.rng.uniform(-pi/4, pi/4), self.rng.uniform(-pi, pi))
 
 
     def make_rigid_rope(self):
@@ -101,7 +98,7 @@ class RopeRenderer:
         if self.rope_radius is not None:
             radius = self.rope_radius
         else:
-            radius = np.random.uniform(0.048, 0.048)
+            radius = self.rng.uniform(0.048, 0.048)
         bpy.ops.transform.resize(value=(radius, radius, radius))
         bpy.ops.object.mode_set(mode='EDIT')
         bpy.ops.transform.rotate(value= pi / 2, orient_axis='X')
@@ -119,7 +116,7 @@ class RopeRenderer:
         if self.rope_screw_offset is not None:
             screw_offset = self.rope_screw_offset
         else:
-            screw_offset = np.random.uniform(12.5, 13)
+            screw_offset = self.rng.uniform(12.5, 13)
         self.rope.modifiers["Screw"].screw_offset = screw_offset 
         if self.rope_iterations is not None:
             rope_iterations = self.rope_iterations
@@ -136,7 +133,7 @@ class RopeRenderer:
         if self.sphere_radius is not None:
             sphere_radius = self.sphere_radius
         else:
-            sphere_radius = np.random.uniform(0.35, 0.37)
+            sphere_radius = self.rng.uniform(0.35, 0.37)
         bpy.ops.transform.resize(value=(sphere_radius, sphere_radius, sphere_radius))
         bpy.ops.transform.rotate(value= pi / 2, orient_axis='X')
         bpy.ops.object.select_all(action='SELECT')
@@ -148,21 +145,32 @@ class RopeRenderer:
         '''
         Create bezier curve
         '''
-        bpy.ops.curve.primitive_bezier_curve_add(location=self.origin)
         if self.bezier_scale is None:
-            self.bezier_scale = np.random.uniform(2.85,3.02)
-        bpy.ops.transform.resize(value=(self.bezier_scale, self.bezier_scale, self.bezier_scale))
-        bpy.ops.object.mode_set(mode='EDIT')
-        bpy.ops.curve.subdivide(number_cuts=self.bezier_subdivisions)
-        bpy.ops.transform.resize(value=(1, 0, 1))
-        bpy.ops.object.mode_set(mode='EDIT')
-        bpy.ops.curve.select_all(action='SELECT')
-        bpy.ops.curve.handle_type_set(type='AUTOMATIC')
-        bpy.ops.object.mode_set(mode='OBJECT')
-        self.bezier = bpy.context.active_object
-        self.bezier_points = self.bezier.data.splines[0].bezier_points
-        self.bezier.name = self.bezier_name
-        self.bezier.select_set(False)
+            self.bezier_scale = self.rng.uniform(2.85,3.02)
+        # Subdivide Blender's default bezier segment directly in numpy (the same points bpy.ops.curve.subdivide inserts) and flatten it onto the x axis
+        ctrl = np.array([[-1, 0, 0], [-0.5, 0.5, 0], [0, 0, 0], [1, 0, 0]])
+        t = np.linspace(0, 1, self.bezier_subdivisions + 2)[:, None]
+        bernstein = np.hstack([(1 - t)**3, 3 * (1 - t)**2 * t, 3 * (1 - t) * t**2, t**3])
+        co = bernstein @ ctrl
+        co[:, 1] = 0
+        curve = bpy.data.curves.new(self.bezier_name, type='CURVE')
+        curve.dimensions = '3D'
+        spline = curve.splines.new('BEZIER')
+        spline.bezier_points.add(len(co) - 1)
+        for point in spline.bezier_points:
+            point.handle_left_type = 'AUTO'
+            point.handle_right_type = 'AUTO'
+        self.bezier = bpy.data.objects.new(self.bezier_name, curve)
+        self.bezier.location = self.origin
+        self.bezier.scale = (self.bezier_scale, self.bezier_scale, self.bezier_scale)
+        bpy.context.collection.objects.link(self.bezier)
+        self.bezier_points = spline.bezier_points
+        self.num_bezier_points = len(co)
+        # Straight rest pose of the curve, also restored before each image by reset_bezier
+        self.bezier_rest = co
+        self.reset_bezier()
+        for obj in bpy.context.selected_objects:
+            obj.select_set(False)
         self.rope_asymm.select_set(True)
         bpy.context.view_layer.objects.active = self.rope_asymm
         # Add bezier curve as deform modifier to the rope
@@ -174,16 +182,27 @@ class RopeRenderer:
         bpy.ops.mesh.normals_make_consistent(inside=False)
         bpy.ops.object.mode_set(mode='OBJECT')
 
+    def reset_bezier(self):
+        # Put the bezier curve back into the straight pose created by make_bezier
+        self.set_bezier_co(self.bezier_rest)
+
+    def set_bezier_co(self, co):
+        # Write an (N, 3) array of control points to the bezier curve in one call
+        self.bezier_points.foreach_set('co', np.asarray(co, dtype=np.float32).ravel())
+        # foreach_set skips Blender's update, so re-set one handle type: that makes Blender recompute the 'AUTO' handles of the whole spline
+        self.bezier_points[0].handle_left_type = 'AUTO'
+        self.bezier.data.update_tag()
+
     def slightly_randomize(self, point, planar=True, max_offset=0.3):
         # Slightly displaces the position of a point (for randomization in rope configurations)
-        offset_x = np.random.uniform(0, max_offset)
-        offset_y  = np.random.uniform(0, max_offset)
-        offset_z  = np.random.uniform(0, max_offset)
-        if np.random.uniform() < 0.5:
+        offset_x = self.rng.uniform(0, max_offset)
+        offset_y  = self.rng.uniform(0, max_offset)
+        offset_z  = self.rng.uniform(0, max_offset)
+        if self.rng.uniform() < 0.5:
             offset_x *= -1
-        if np.random.uniform() < 0.5:
+        if self.rng.uniform() < 0.5:
             offset_y *= -1
-        if np.random.uniform() < 0.5:
+        if self.rng.uniform() < 0.5:
             offset_z *= -1
         point.co.x += offset_x
         point.co.y += offset_y
@@ -199,30 +218,31 @@ class RopeRenderer:
         #       \5/__\____________
         #       / \   | 
         #______0   3__|  
-        p0 = np.random.choice(range(4, len(self.bezier_points) - 5))
-        y_shift = random.uniform(offset_min, offset_max)*np.random.uniform(0.95, 1.5)
-        x_shift_1 = random.uniform(offset_min/3, offset_max/3)*np.random.uniform(0.95, 1.5)
-        x_shift_2 = random.uniform(offset_min/3, offset_max/3)*np.random.uniform(0.95, 1.5)
-        self.bezier_points[p0 + 1].co.y += y_shift 
-        self.bezier_points[p0 + 1].co.x -= x_shift_1
-        self.bezier_points[p0 + 2].co.y += y_shift
-        self.bezier_points[p0 + 2].co.x += x_shift_2 * np.random.uniform(0, 2) * np.random.choice([-1, 1])
+        p0 = self.rng.integers(4, self.num_bezier_points - 5)
+        y_shift = self.rng.uniform(offset_min, offset_max)*self.rng.uniform(0.95, 1.5)
+        x_shift_1 = self.rng.uniform(offset_min/3, offset_max/3)*self.rng.uniform(0.95, 1.5)
+        x_shift_2 = self.rng.uniform(offset_min/3, offset_max/3)*self.rng.uniform(0.95, 1.5)
+        # Arrange the six affected points in numpy, then write each one back with a single assignment
+        loop = np.array([self.bezier_points[p0 + i].co for i in range(6)])
+        loop[1, 1] += y_shift
+        loop[1, 0] -= x_shift_1
+        loop[2, 1] += y_shift
+        loop[2, 0] += x_shift_2 * self.rng.uniform(0, 2) * self.rng.choice([-1, 1])
 
-        self.bezier_points[p0 + 1].co.x, self.bezier_points[p0 + 2].co.x = self.bezier_points[p0 + 2].co.x, self.bezier_points[p0 + 1].co.x
-        self.bezier_points[p0 + 1].co.z += 0.025 # TODO: sorry, this is a hack for now
-        self.bezier_points[p0 + 3].co.z += 0.025
-        self.bezier_points[p0 + 3].co.x -= np.random.uniform(0.0, 0.2)
-        self.bezier_points[p0 + 4].co.y = self.bezier_points[p0 + 1].co.y
-        if np.random.uniform() < 0.5:
-            self.bezier_points[p0 + 4].co.x = (self.bezier_points[p0 + 1].co.x + self.bezier_points[p0 + 2].co.x)/2
-            self.bezier_points[p0 + 5].co = Vector((self.bezier_points[p0 + 1].co.x, (self.bezier_points[p0].co.y + self.bezier_points[p0 + 1    ].co.y)/2, 0.1)) 
-        self.bezier_points[p0 + 5].co.x += np.random.uniform(0.0, 0.2) * np.random.choice([-1, 1])
+        loop[[1, 2], 0] = loop[[2, 1], 0]
+        loop[[1, 3], 2] += 0.025 # TODO: sorry, this is a hack for now
+        loop[3, 0] -= self.rng.uniform(0.0, 0.2)
+        loop[4, 1] = loop[1, 1]
+        if self.rng.uniform() < 0.5:
+            loop[4, 0] = (loop[1, 0] + loop[2, 0])/2
+            loop[5] = (loop[1, 0], (loop[0, 1] + loop[1, 1])/2, 0.1)
+        loop[5, 0] += self.rng.uniform(0.0, 0.2) * self.rng.choice([-1, 1])
         
-        if np.random.uniform() < 0.5:
-            x_offset = np.random.uniform(0.3, 0.6)
-            for i in range(6):
-                if i != 3:
-                    self.bezier_points[p0 + i].co.x += x_offset
+        if self.rng.uniform() < 0.5:
+            x_offset = self.rng.uniform(0.3, 0.6)
+            loop[[0, 1, 2, 4, 5], 0] += x_offset
+        for i, co in enumerate(loop.tolist()):
+            self.bezier_points[p0 + i].co = co
         return set(range(p0, p0 + 5))
 
     def make_simple_overlap(self, offset_min, offset_max):
@@ -234,11 +254,11 @@ class RopeRenderer:
         #       \ /
         #       / \    
         #______0   3_____ 
-        p0 = np.random.choice(range(len(self.bezier_points) - 5))
-        y_shift = random.uniform(offset_min, offset_max)
-        x_shift_1 = random.uniform(offset_min/3, offset_max/3)
-        x_shift_2 = random.uniform(offset_min/3, offset_max/3)
-        if random.uniform(0, 1) < 0.5:
+        p0 = self.rng.integers(self.num_bezier_points - 5)
+        y_shift = self.rng.uniform(offset_min, offset_max)
+        x_shift_1 = self.rng.uniform(offset_min/3, offset_max/3)
+        x_shift_2 = self.rng.uniform(offset_min/3, offset_max/3)
+        if self.rng.uniform(0, 1) < 0.5:
             y_shift *= -1
         self.bezier_points[p0 + 1].co.y += y_shift
         self.bezier_points[p0 + 1].co.x -= x_shift_1
@@ -250,30 +270,27 @@ class RopeRenderer:
 
     def randomize_nodes(self, num, offset_min, offset_max, nonplanar=False, offlimit_indices=set()):
         # Simulating pulling NUM nodes on the rope by (offset_min, offset_max) amount; nonplanar indicates whether upward pulls are allowed, and offlimit_indices specifies Bezier knots that should not be touched (For instance, if you made a loop and wanted to randomize the remaining nodes on the rope)
-        knots_idxs = np.random.choice(list(set(range(len(self.bezier_points))) ^ offlimit_indices), min(num, len(self.bezier_points)), replace=False)
-        for idx in knots_idxs:
-            knot = self.bezier_points[idx]
-            offset_y = random.uniform(offset_min, offset_max)
-            offset_x = random.uniform(offset_min/2, offset_max/2)
-            if random.uniform(0, 1) < 0.5:
-                offset_y *= -1
-            if random.uniform(0, 1) < 0.5:
-                offset_x *= -1
-            if nonplanar:
-                offset_z = random.uniform(offset_min, offset_max)
-                if random.uniform(0, 1) < 0.5:
-                    offset_z *= -1
-                knot.co.z += offset_z
-            res_y = knot.co.y + offset_y
-            res_x = knot.co.x + offset_x
-            knot.co.y = res_y
-            knot.co.x = res_x
+        allowed = np.ones(self.num_bezier_points, dtype=bool)
+        allowed[list(offlimit_indices)] = False
+        pool = np.flatnonzero(allowed)
+        knots_idxs = self.rng.choice(pool, min(num, pool.size), replace=False)
+        # Draw all (x, y, z) offsets and their signs at once; x offsets are drawn from half the range
+        offsets = self.rng.uniform(offset_min, offset_max, size=(len(knots_idxs), 3))
+        offsets *= np.where(self.rng.uniform(size=(len(knots_idxs), 3)) < 0.5, -1, 1)
+        offsets[:, 0] *= 0.5
+        if not nonplanar:
+            offsets[:, 2] = 0
+        co = np.empty(self.num_bezier_points * 3, dtype=np.float32)
+        self.bezier_points.foreach_get('co', co)
+        co = co.reshape(-1, 3)
+        co[knots_idxs] += offsets
+        self.set_bezier_co(co)
 
     def reposition_camera(self):
         # Orient camera towards the rope
         bpy.context.scene.camera = self.camera
         bpy.ops.view3d.camera_to_view_selected()
-        self.camera.location.z += np.random.uniform(3.3, 3.6)
+        self.camera.location.z += self.rng.uniform(3.3, 3.6)
 
     def render_single_scene(self, M_pix=20, M_depth=0.2):
 		# Produce a single image of the current scene, save_rgb the mesh vertex pixel coords
@@ -282,72 +299,86 @@ class RopeRenderer:
         depsgraph = bpy.context.evaluated_depsgraph_get()
         rope_deformed = self.rope_asymm.evaluated_get(depsgraph)
         # Get rope mesh vertices in world space
-        coords = [rope_deformed.matrix_world @ v.co for v in list(rope_deformed.data.vertices)[::self.coord_offset]] # TODO: this is actually where i specify how many vertices to export (play around with :20); will standardize this
+        num_verts = len(rope_deformed.data.vertices)
+        verts = np.empty(num_verts * 3, dtype=np.float32)
+        rope_deformed.data.vertices.foreach_get('co', verts)
+        verts = verts.reshape(num_verts, 3)[::self.coord_offset] # TODO: this is actually where i specify how many vertices to export (play around with :20); will standardize this
+        world_matrix = np.asarray(rope_deformed.matrix_world)
+        coords = verts @ world_matrix[:3, :3].T + world_matrix[:3, 3]
         print("%d Vertices" % len(coords))
-        pixels = {}
-        scene.render.resolution_percentage = 100
         render_scale = scene.render.resolution_percentage / 100
-        scene.render.resolution_x = 640
-        scene.render.resolution_y = 480
         render_size = (
                 int(scene.render.resolution_x * render_scale),
                 int(scene.render.resolution_y * render_scale),
                 )
 
-        for i in range(len(coords)):
-            coord = coords[i]
-            camera_coord = bpy_extras.object_utils.world_to_camera_view(scene, self.camera, coord)
-            render_scale = scene.render.resolution_percentage / 100
-            render_size = (
-                    int(scene.render.resolution_x * render_scale),
-                    int(scene.render.resolution_y * render_scale),
-                    )
-            p = (round(camera_coord.x * render_size[0]), round(render_size[1] - camera_coord.y * render_size[1]))
-            pixels[i] = [p, camera_coord]
+        # Project all vertices into the camera with one matrix multiply (same result as world_to_camera_view per vertex)
+        view_matrix = np.asarray(self.camera.matrix_world.inverted())
+        proj_matrix = np.asarray(self.camera.calc_matrix_camera(depsgraph, x=render_size[0], y=render_size[1]))
+        coords4 = np.hstack([coords, np.ones((len(coords), 1))])
+        view = coords4 @ view_matrix.T
+        clip = view @ proj_matrix.T
+        ndc = clip[:, :3] / clip[:, 3:4]
+        px = np.round((ndc[:, 0] * 0.5 + 0.5) * render_size[0]).astype(int)
+        py = np.round((0.5 - ndc[:, 1] * 0.5) * render_size[1]).astype(int)
+        cam_z = -view[:, 2] # distance in front of the camera, which is what world_to_camera_view reports as z
 
-        pixels_raw = {i: [pixels[i][0]] for i in pixels}
-        pixels_unoccluded = copy.deepcopy(pixels_raw)
-        # Run kNN on mesh vertex pixels
-        neigh = NearestNeighbors(4, M_pix)
-        pixels_list = [v[0] for v in pixels.values()]
+        final_pixs_raw = [[p] for p in zip(px.tolist(), py.tolist())]
+        # Vertices that project outside the image (or behind the camera) are invalid and kept out of the kNN tree
+        valid = (px >= 0) & (px < render_size[0]) & (py >= 0) & (py < render_size[1]) & (cam_z > 0)
+        on_screen = np.flatnonzero(valid)
+        # The rope is thin, so many vertices land on the same pixel: keep one entry per pixel, holding the depth of its front-most vertex
+        pix_xy, pix_of_vertex = np.unique(np.stack([px, py], axis=1)[on_screen], axis=0, return_inverse=True)
+        pix_of_vertex = pix_of_vertex.ravel()
+        front_z = np.full(len(pix_xy), np.inf)
+        np.minimum.at(front_z, pix_of_vertex, cam_z[on_screen])
+        if len(pix_xy) >= 4:
+            # Run kNN on the unique on-screen pixels (one batched query for all pixels instead of one per pixel)
+            # Few, 2D points: bigger leaves and an unbalanced, non-compacted tree are cheaper to build than the defaults
+            tree = cKDTree(pix_xy.astype(np.float64), leafsize=32, balanced_tree=False, compact_nodes=False)
+            # Only pixels within M_pix count as neighbors; missing neighbors come back as index len(pix_xy)
+            _, knn_idxs = tree.query(pix_xy, k=4, distance_upper_bound=M_pix, workers=-1)
+            front_z_padded = np.append(front_z, np.inf) # a missing neighbor is infinitely far back, so it never occludes
 
-        #Prune out occluded pixels (reparent all occluded pixels in a region to the top most mesh vertex in that region
-        neigh.fit(pixels_list)
-        for j in pixels:
-            (p, q), camera_coord = pixels[j]
-            match_idxs = neigh.kneighbors([(p, q)], 4, return_distance=False)
-            for match_idx in match_idxs.squeeze().tolist()[1:]: # Get k neighbors, not including the original pixel (p, q)
-                x, y = pixels[match_idx][0]
-                c1, c2 = camera_coord, pixels[match_idx][1]
-                # If one mesh vertex is below another, its pixel coord is invalid
-                if c1.z - c2.z > M_depth: #c1 on top by at least M_depth
-                    try:
-                        pixels_unoccluded[j].remove((p, q))
-                        pixels_unoccluded[match_idx].append((p, q))
-
-                    except:
-                        pass
-                elif c1.z - c2.z < -M_depth: #c2 on top by at least M_depth
-                    try:
-                        pixels_unoccluded[match_idx].remove((x, y))
-                        pixels_unoccluded[j].append((x, y))
-                    except:
-                        pass
-        print("Null entries", sum(1 for i in pixels_unoccluded if pixels_unoccluded[i] == []))
+            # Prune out occluded pixels: if a mesh vertex lies behind the front-most vertex of its own or a neighboring pixel
+            # (neighbors from kNN, including the vertex's own pixel) by at least M_depth, its pixel coord is invalid
+            dz = cam_z[on_screen, None] - front_z_padded[knn_idxs[pix_of_vertex]]
+            valid[on_screen[np.any(dz > M_depth, axis=1)]] = False
+        else:
+            valid[on_screen[cam_z[on_screen] - front_z[pix_of_vertex] > M_depth]] = False
+        final_pixs_unoccluded = [p if v else [] for p, v in zip(final_pixs_raw, valid.tolist())]
+        print("Null entries", int(np.count_nonzero(~valid)))
 
-        
-        final_pixs_raw = list(pixels_raw.values())
-        final_pixs_unoccluded = list(pixels_unoccluded.values())
         filename = "{0:06d}_rgb.png".format(self.i)
+        if self.save_rgb:
+            if self.save_depth:
+                scene.render.engine = 'BLENDER_WORKBENCH' # the depth pass shares the scene, so switch engines between passes
+            scene.render.filepath = "./images/{}".format(filename)
+            bpy.ops.render.render(use_viewport = True, write_still=True)
+        if self.save_depth:
+            if self.save_rgb:
+                scene.render.engine = 'BLENDER_EEVEE'
+            scene.render.filepath = "./images/{}".format(filename)
+            bpy.ops.render.render(write_still=True)
+        if self.knots_info is not None:
+            #self.knots_info.write(json.dumps({str(self.i): final_pixs_unoccluded}) + "\n")
+            self.knots_info.write(json.dumps({str(self.i): final_pixs_raw}) + "\n")
+            self.knots_info.flush() # keep every rendered image's annotations on disk even if a later render fails
+        self.i += 1
+
+
+    def setup_render(self):
+        # Render settings and the depth compositing graph are the same for every image, so configure them once
+        scene = bpy.context.scene
+        scene.render.resolution_percentage = 100
+        scene.render.resolution_x = 640
+        scene.render.resolution_y = 480
         if self.save_rgb:
             scene.world.color = (1, 1, 1)
-            scene.render.display_mode
             scene.render.engine = 'BLENDER_WORKBENCH'
             scene.display_settings.display_device = 'None'
             scene.sequencer_colorspace_settings.name = 'XYZ'
             scene.render.image_settings.file_format='PNG'
-            scene.render.filepath = "./images/{}".format(filename)
-            bpy.ops.render.render(use_viewport = True, write_still=True)
         if self.save_depth:
             scene.render.engine = 'BLENDER_EEVEE'
             scene.eevee.taa_samples = 1
@@ -368,12 +399,42 @@ class RopeRenderer:
             links.new(inv_node.outputs[0], norm_node.inputs[0])
             links.new(norm_node.outputs[0], composite.inputs["Image"])
             scene.render.use_multiview = False
-            scene.render.filepath = "./images/{}".format(filename)
-            bpy.ops.render.render(write_still=True)
-        #self.knots_info[self.i] = final_pixs_unoccluded
-        self.knots_info[self.i] = final_pixs_raw
-        self.i += 1
 
+    def setup(self):
+        # Build the scene once; every image after this only re-poses the bezier curve and the camera
+        self.clear()
+        self.setup_render()
+        self.add_camera()
+        self.make_rigid_rope()
+        self.add_rope_asymmetry()
+        self.make_bezier()
+
+    def randomize_and_render(self):
+        # Deform the rope into a new random configuration and render it
+        self.reset_bezier()
+        self.randomize_camera()
+        if self.nonplanar:
+            # Generate a split of loops, knots, and planar configs
+            rand = self.rng.uniform()
+            if rand < 0.45: 
+                loop_rand = self.rng.uniform(0.32, 0.4)
+                loop_indices = self.make_simple_loop(loop_rand, loop_rand)
+                self.randomize_nodes(3, 0.05, 0.1, offlimit_indices=loop_indices)
+            elif rand < 0.7:
+                loop_rand = self.rng.uniform(0.32, 0.4)
+                loop_indices = self.make_simple_overlap(loop_rand, loop_rand)
+                self.randomize_nodes(3, 0.05, 0.1, offlimit_indices=loop_indices)
+            else:
+                self.randomize_nodes(3, 0.6, 0.6)
+                self.randomize_nodes(3, 0.2, 0.2)
+                self.randomize_nodes(3, 0.2, 0.2)
+        else:
+            # Generate only planar configs
+                self.randomize_nodes(3, 0.6, 0.6)
+                self.randomize_nodes(3, 0.2, 0.2)
+                self.randomize_nodes(3, 0.2, 0.2)
+        self.reposition_camera()
+        self.render_single_scene(M_pix=10)
 
     def run(self):
         # Create new images folder to dump rendered images
@@ -382,42 +443,18 @@ class RopeRenderer:
         else:
             os.system('rm -rf ./images')
             os.makedirs('./images')
-        for i in range(self.num_images):
-            x = time.time()
-            self.clear()
-            self.add_camera()
-            self.make_rigid_rope()
-            self.add_rope_asymmetry()
-            self.make_bezier()
-            if self.nonplanar:
-                # Generate a split of loops, knots, and planar configs
-                rand = np.random.uniform()
-                if rand < 0.45: 
-                    loop_rand = np.random.uniform(0.32, 0.4)
-                    loop_indices = self.make_simple_loop(loop_rand, loop_rand)
-                    self.randomize_nodes(3, 0.05, 0.1, offlimit_indices=loop_indices)
-                elif rand < 0.7:
-                    loop_rand = np.random.uniform(0.32, 0.4)
-                    loop_indices = self.make_simple_overlap(loop_rand, loop_rand)
-                    self.randomize_nodes(3, 0.05, 0.1, offlimit_indices=loop_indices)
-                else:
-                    self.randomize_nodes(3, 0.6, 0.6)
-                    self.randomize_nodes(3, 0.2, 0.2)
-                    self.randomize_nodes(3, 0.2, 0.2)
-            else:
-                # Generate only planar configs
-                    self.randomize_nodes(3, 0.6, 0.6)
-                    self.randomize_nodes(3, 0.2, 0.2)
-                    self.randomize_nodes(3, 0.2, 0.2)
-            self.reposition_camera()
-            self.render_single_scene(M_pix=10)
-            print("Total time for scene {}s.".format(str((time.time() - x) % 60)))
-        if self.save_depth or self.save_rgb:
-            with open("./images/knots_info.json", 'w') as outfile:
-                json.dump(self.knots_info, outfile, sort_keys=True, indent=2)
+        # Annotations are only kept when images are saved; otherwise they go nowhere
+        knots_path = "./images/knots_info.jsonl" if (self.save_depth or self.save_rgb) else os.devnull
+        with open(knots_path, 'w') as self.knots_info:
+            self.setup()
+            for i in range(self.num_images):
+                x = time.time()
+                self.randomize_and_render()
+                print("Total time for scene {}s.".format(str((time.time() - x) % 60)))
+        self.knots_info = None
 
 if __name__ == '__main__':
     with open("params.json", "r") as f:
         rope_params = json.load(f)
-    renderer = RopeRenderer(save_depth=rope_params["save_depth"], save_rgb=(not rope_params["save_depth"]), num_images = rope_params["num_images"], coord_offset=rope_params["coord_offset"], bezier_knots=rope_params["bezier_knots"])
+    renderer = RopeRenderer(save_depth=rope_params["save_depth"], save_rgb=(not rope_params["save_depth"]), num_images = rope_params["num_images"], coord_offset=rope_params["coord_offset"], bezier_knots=rope_params["bezier_knots"], seed=rope_params.get("seed"))
     renderer.run()
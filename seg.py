@@ -1,12 +1,12 @@
 import numpy as np
 import os
 import cv2
-from sklearn.neighbors import NearestNeighbors
+from scipy.spatial import cKDTree
 
-def pixelNN(idxs, model, inputs, img):
+def pixelNN(idxs, tree, inputs, img):
     pixels = np.dstack(idxs[:2]).squeeze()
-    closest_px = model.kneighbors(pixels, 1, return_distance=False).squeeze()
-    matched_pixels = inputs[closest_px].squeeze()
+    _, closest_px = tree.query(pixels, k=1, workers=-1)
+    matched_pixels = inputs[closest_px]
     x = matched_pixels[:,0]
     y = matched_pixels[:,1]
     return img[x, y]
@@ -15,10 +15,9 @@ def segment(mask, annotated, i):
     segmented = mask.copy()
     colored_idxs = np.where((annotated > [1, 1, 1]))
     annotated_pixels = np.dstack(colored_idxs[:2]).squeeze()
-    neigh = NearestNeighbors(1, 5)
-    neigh.fit(annotated_pixels)
+    tree = cKDTree(annotated_pixels)
     masked_indices = np.where((mask == [255, 255, 255]))
-    segmented[masked_indices[:2]] = [pixelNN(masked_indices, neigh, annotated_pixels, annotated)]
+    segmented[masked_indices[:2]] = [pixelNN(masked_indices, tree, annotated_pixels, annotated)]
     cv2.imwrite('partitioned/%06d_segmented.png' % i, segmented)
     #indices = np.where((img <= [a]) & (img >= [b]))
     #img[indices] = [m(img[indices])]